@@ -1,19 +1,29 @@
 import os
+import io
+import asyncio
 import logging
 import zipfile
 import tempfile
-import json
+import shutil
 import time
-from datetime import datetime
-from PIL import Image
-import pillow_avif
+import atexit
+from functools import lru_cache
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from cryptography.fernet import Fernet
-from base64 import b64encode
+import orjson
+from base64 import urlsafe_b64encode
 from hashlib import sha256
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
+try:
+    import libarchive  # Optional: inflates ZIPs without holding the GIL
+except (ImportError, OSError, AttributeError):
+    # OSError/AttributeError: the package is installed but the system libarchive is missing or broken
+    libarchive = None
+
 # Load environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -38,19 +48,46 @@ SUPPORTED_FORMATS = {
     'AVIF': '.avif' # Added AVIF
 }
 
+# Encoder options per target format, tuned for fast batch encoding over maximum compression
+SAVE_KWARGS = {
+    'WEBP': {'method': 0, 'quality': 85},
+    'PNG': {'compress_level': 1, 'optimize': False},
+    'AVIF': {'speed': 8, 'quality': 70},
+}
+
+# File extensions accepted from ZIP archives
+SUPPORTED_EXTS = tuple(sorted(set(SUPPORTED_FORMATS.values()) | {'.jpeg'}))
+
+# Pillow and its AVIF plugin are imported on first use, see load_pil()
+Image = None
+
+# Worker pool shared by all conversion batches
+CONVERSION_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Chunk size for streaming copies out of ZIP archives
+COPY_BUFFER_SIZE = 1024 * 1024
+# Minimum delay between progress message edits, Telegram allows about one per second per chat
+PROGRESS_EDIT_INTERVAL = 1.2
+
 # Statistics file
 STATS_FILE = 'bot_statistics.json'
+# Minimum delay between statistics writes during a batch (seconds)
+STATS_SAVE_INTERVAL = 5.0
+# Days of per-day statistics to keep, older days only survive in the monthly totals
+DAILY_STATS_RETENTION_DAYS = 90
 
 
 class Statistics:
     def __init__(self):
         self.stats = self.load_stats()
+        self._dirty = False
+        self._last_save = 0
 
     def load_stats(self):
         try:
             if os.path.exists(STATS_FILE):
-                with open(STATS_FILE, 'r') as f:
-                    return json.load(f)
+                with open(STATS_FILE, 'rb') as f:
+                    return orjson.loads(f.read())
         except Exception as e:
             logger.error(f"Error loading statistics: {e}")
         return {
@@ -63,15 +100,38 @@ class Statistics:
         }
 
     def save_stats(self):
+        temp_path = None
         try:
-            with open(STATS_FILE, 'w') as f:
-                json.dump(self.stats, f)
+            # Write to a temp file and swap it in so a crash never leaves a truncated file
+            stats_dir = os.path.dirname(os.path.abspath(STATS_FILE))
+            with tempfile.NamedTemporaryFile('wb', dir=stats_dir, suffix='.tmp', delete=False) as f:
+                temp_path = f.name
+                f.write(orjson.dumps(self.stats, option=orjson.OPT_NON_STR_KEYS))
+            # NamedTemporaryFile is created as 0600, keep the existing file's permissions
+            if os.path.exists(STATS_FILE):
+                shutil.copymode(STATS_FILE, temp_path)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, STATS_FILE)
+            temp_path = None
+            self._dirty = False
+            self._last_save = time.monotonic()
         except Exception as e:
             logger.error(f"Error saving statistics: {e}")
+        finally:
+            if temp_path is not None:
+                try: os.unlink(temp_path)
+                except OSError as e_unlink: logger.error(f"Error removing temporary statistics file {temp_path}: {e_unlink}")
+
+    def flush(self):
+        """Persist pending statistics changes, if any."""
+        if self._dirty:
+            self.save_stats()
 
     def update_conversion_stats(self, original_size, converted_size, target_format):
-        today = datetime.now().strftime('%Y-%m-%d')
-        month = datetime.now().strftime('%Y-%m')
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        month = today[:7]
 
         # Update total stats
         self.stats['total_images'] += 1
@@ -79,64 +139,77 @@ class Statistics:
         self.stats['total_size_converted'] += converted_size
 
         # Update format stats
-        if target_format not in self.stats['conversions_by_format']:
-            self.stats['conversions_by_format'][target_format] = 0
-        self.stats['conversions_by_format'][target_format] += 1
+        conversions_by_format = self.stats['conversions_by_format']
+        conversions_by_format[target_format] = conversions_by_format.get(target_format, 0) + 1
 
-        # Update daily stats
+        # Drop expired daily entries whenever a new day starts
         if today not in self.stats['daily_stats']:
-            self.stats['daily_stats'][today] = {
-                'images': 0,
-                'size_original': 0,
-                'size_converted': 0
-            }
-        self.stats['daily_stats'][today]['images'] += 1
-        self.stats['daily_stats'][today]['size_original'] += original_size
-        self.stats['daily_stats'][today]['size_converted'] += converted_size
-
-        # Update monthly stats
-        if month not in self.stats['monthly_stats']:
-            self.stats['monthly_stats'][month] = {
-                'images': 0,
-                'size_original': 0,
-                'size_converted': 0
+            cutoff = (now - timedelta(days=DAILY_STATS_RETENTION_DAYS)).strftime('%Y-%m-%d')
+            self.stats['daily_stats'] = {
+                day: day_stats for day, day_stats in self.stats['daily_stats'].items() if day >= cutoff
             }
-        self.stats['monthly_stats'][month]['images'] += 1
-        self.stats['monthly_stats'][month]['size_original'] += original_size
-        self.stats['monthly_stats'][month]['size_converted'] += converted_size
 
-        self.save_stats()
+        # Update daily and monthly stats
+        for period_stats in (
+            self.stats['daily_stats'].setdefault(today, {'images': 0, 'size_original': 0, 'size_converted': 0}),
+            self.stats['monthly_stats'].setdefault(month, {'images': 0, 'size_original': 0, 'size_converted': 0}),
+        ):
+            period_stats['images'] += 1
+            period_stats['size_original'] += original_size
+            period_stats['size_converted'] += converted_size
+
+        self._dirty = True
+        if time.monotonic() - self._last_save > STATS_SAVE_INTERVAL:
+            self.save_stats()
 
 
 # Initialize statistics
 stats = Statistics()
+atexit.register(stats.flush)
 
 
+def load_pil():
+    """Import Pillow and register the AVIF plugin on first use."""
+    global Image
+    if Image is None:
+        from PIL import Image as pil_image
+        import pillow_avif  # Registers the AVIF codec with Pillow
+        Image = pil_image
+    return Image
+
+
+@lru_cache(maxsize=1024)
 def get_encryption_key(session_id: str) -> bytes:
     """Generate a unique encryption key for each session."""
     combined = f"{SESSION_PASSWORD}{session_id}"
-    return base64.urlsafe_b64encode(sha256(combined.encode()).digest())
+    return urlsafe_b64encode(sha256(combined.encode()).digest())
+
+
+@lru_cache(maxsize=1024)
+def get_session_cipher(session_id: str):
+    """Return the Fernet instance for a session, reused across calls."""
+    from cryptography.fernet import Fernet
+    return Fernet(get_encryption_key(session_id))
 
 
 def encrypt_data(data: bytes, session_id: str) -> bytes:
     """Encrypt data using session-specific key."""
-    f = Fernet(get_encryption_key(session_id))
-    return f.encrypt(data)
+    return get_session_cipher(session_id).encrypt(data)
 
 
 def decrypt_data(encrypted_data: bytes, session_id: str) -> bytes:
     """Decrypt data using session-specific key."""
-    f = Fernet(get_encryption_key(session_id))
-    return f.decrypt(encrypted_data)
+    return get_session_cipher(session_id).decrypt(encrypted_data)
+
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 
 def format_size(size_bytes):
     """Format file size in human-readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.1f} GB"
+    # Every unit is 2**10 times the previous one, so the bit length picks the unit directly
+    exponent = min(max(int(abs(size_bytes)).bit_length() - 1, 0) // 10, len(SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * exponent)):.1f} {SIZE_UNITS[exponent]}"
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,7 +269,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         total_stats = stats.stats
         format_stats = "\n".join(
             f"- {fmt}: {count} images"
-            for fmt, count in total_stats['conversions_by_format'].items()
+            for fmt, count in Counter(total_stats['conversions_by_format']).most_common()
         )
 
         stats_message = (
@@ -243,26 +316,36 @@ def get_format_buttons():
     return InlineKeyboardMarkup(keyboard)
 
 
+# The keyboard never changes, so build it once
+FORMAT_KEYBOARD = get_format_buttons()
+
+
+def detect_image_format(image_data, original_name):
+    """Read the image header once to detect its format. Returns None if it is not a readable image."""
+    try:
+        with Image.open(image_data) as img:
+            return img.format if img.format else "Unknown"
+    except Exception as e:
+        logger.error(f"Error reading image {original_name} in detect_image_format: {str(e)}")
+        return None
+
+
 def get_image_info(pending_images_data):
-    """Get summary of images and their formats. pending_images_data is a list of (path, original_name)."""
+    """Get summary of images and their formats.
+
+    pending_images_data is a list of (BytesIO, original_name, format_name, size)
+    as recorded at upload time, so no image is re-read here.
+    """
     formats = {}
     total_size = 0
-    image_paths = [item[0] for item in pending_images_data]
 
-    for path in image_paths:
-        try:
-            if not os.path.exists(path):
-                logger.warning(f"File {path} not found in get_image_info. Skipping.")
-                continue
-            total_size += os.path.getsize(path)
-            with Image.open(path) as img:
-                format_name = img.format if img.format else "Unknown"
-                formats[format_name] = formats.get(format_name, 0) + 1
-        except Exception as e:
-            logger.error(f"Error reading image {path} in get_image_info: {str(e)}")
+    for _, _, format_name, size in pending_images_data:
+        total_size += size
+        if format_name is not None:
+            formats[format_name] = formats.get(format_name, 0) + 1
     
     summary = []
-    total_images = len(image_paths)
+    total_images = len(pending_images_data)
     summary.append(f"📸 Total images: {total_images} ({format_size(total_size)})")
     if not formats:
         summary.append("- No image formats detected yet (or files are not images).")
@@ -276,9 +359,11 @@ def get_image_info(pending_images_data):
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle received images."""
     try:
+        load_pil()
+
         # Initialize or get the image collection for this user
         if 'pending_images' not in context.user_data:
-            context.user_data['pending_images'] = []  # Stores tuples: (temp_file_path, original_filename)
+            context.user_data['pending_images'] = []  # Stores tuples: (BytesIO, original_filename, format_name, size)
             context.user_data['message_to_edit'] = None
 
         # Get the file
@@ -289,12 +374,14 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # We'll use the file_unique_id to make it somewhat distinguishable
         original_filename = f"image_{photo.file_unique_id}.jpg" # Assume jpg, will be detected later by PIL
 
-        # Download the file
-        # We use a suffix that helps identify the original, though PIL will determine actual format
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{original_filename}") as temp_file_obj:
-            await file.download_to_drive(temp_file_obj.name)
-            context.user_data['pending_images'].append((temp_file_obj.name, original_filename))
-            logger.info(f"Downloaded direct image to {temp_file_obj.name} (original: {original_filename})")
+        # Download the file straight into memory, PIL will determine the actual format
+        image_data = io.BytesIO()
+        await file.download_to_memory(image_data)
+        image_size = image_data.getbuffer().nbytes
+        context.user_data['pending_images'].append(
+            (image_data, original_filename, detect_image_format(image_data, original_filename), image_size)
+        )
+        logger.info(f"Downloaded direct image {original_filename} ({format_size(image_size)})")
 
         # Update or send the status message
         status_text = (
@@ -306,19 +393,19 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await context.user_data['message_to_edit'].edit_text(
                     status_text,
-                    reply_markup=get_format_buttons()
+                    reply_markup=FORMAT_KEYBOARD
                 )
             except Exception:
                 # If editing fails, send a new message
                 message = await update.message.reply_text(
                     status_text,
-                    reply_markup=get_format_buttons()
+                    reply_markup=FORMAT_KEYBOARD
                 )
                 context.user_data['message_to_edit'] = message
         else:
             message = await update.message.reply_text(
                 status_text,
-                reply_markup=get_format_buttons()
+                reply_markup=FORMAT_KEYBOARD
             )
             context.user_data['message_to_edit'] = message
 
@@ -327,6 +414,55 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Sorry, there was an error processing your image. Please try again.")
 
 
+def _zip_image_name(member_path):
+    """Return the name to keep for a ZIP member, or None if it should be skipped.
+
+    The folder path is kept so same-named images in different folders stay apart.
+    macOS metadata (__MACOSX/ folders and ._ AppleDouble files) is skipped.
+    """
+    parts = [part for part in member_path.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    if not parts or parts[0] == '__MACOSX' or parts[-1].startswith('._'):
+        return None
+    if not parts[-1].lower().endswith(SUPPORTED_EXTS):
+        return None
+    return '/'.join(parts)
+
+
+def _read_zip_images(zip_data):
+    """Read the supported images of an in-memory ZIP into memory. Runs in a worker thread.
+
+    Returns a list of (filename, BytesIO). Uses libarchive when it is installed,
+    otherwise falls back to zipfile. Nothing is extracted to disk.
+    """
+    zip_images = []
+
+    if libarchive is not None:
+        with libarchive.memory_reader(zip_data.getvalue()) as archive:
+            for entry in archive:
+                filename_in_zip = _zip_image_name(entry.pathname)
+                if entry.isfile and filename_in_zip:
+                    image_data = io.BytesIO()
+                    for block in entry.get_blocks():
+                        image_data.write(block)
+                    zip_images.append((filename_in_zip, image_data))
+                else:
+                    logger.info(f"Skipping non-image file or directory from ZIP: {entry.pathname}")
+        return zip_images
+
+    with zipfile.ZipFile(zip_data, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            filename_in_zip = _zip_image_name(info.filename)
+            if not info.is_dir() and filename_in_zip:
+                # Stream the member straight into memory
+                image_data = io.BytesIO()
+                with zip_ref.open(info) as src_img_file:
+                    shutil.copyfileobj(src_img_file, image_data, length=COPY_BUFFER_SIZE)
+                zip_images.append((filename_in_zip, image_data))
+            else:
+                logger.info(f"Skipping non-image file or directory from ZIP: {info.filename}")
+    return zip_images
+
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle received documents (ZIP files)."""
     try:
@@ -334,40 +470,25 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mime_type = document.mime_type
 
         if mime_type == 'application/zip':
+            load_pil()
             if 'pending_images' not in context.user_data:
-                context.user_data['pending_images'] = [] # Stores tuples: (temp_file_path, original_filename)
+                context.user_data['pending_images'] = [] # Stores tuples: (BytesIO, original_filename, format_name, size)
                 context.user_data['message_to_edit'] = None
 
             file = await context.bot.get_file(document.file_id)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as temp_zip_file:
-                await file.download_to_drive(temp_zip_file.name)
-                zip_download_path = temp_zip_file.name
-                logger.info(f"Downloaded ZIP to {zip_download_path}")
-
-            with tempfile.TemporaryDirectory() as temp_extract_dir:
-                logger.info(f"Extracting ZIP {zip_download_path} to {temp_extract_dir}")
-                with zipfile.ZipFile(zip_download_path, 'r') as zip_ref:
-                    zip_ref.extractall(temp_extract_dir)
-                logger.info(f"Extraction complete.")
-
-                for filename_in_zip in os.listdir(temp_extract_dir):
-                    original_full_path = os.path.join(temp_extract_dir, filename_in_zip)
-                    if os.path.isfile(original_full_path) and \
-                       any(filename_in_zip.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.webp', '.gif', '.tiff', '.bmp', '.avif']): # Added .avif
-                        
-                        # Create a new temporary file to store this image from the zip,
-                        # ensuring it persists until we are done with it.
-                        # Suffix helps in debugging, not functionally critical here.
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{filename_in_zip}") as temp_image_storage:
-                            with open(original_full_path, 'rb') as src_img_file:
-                                temp_image_storage.write(src_img_file.read())
-                            context.user_data['pending_images'].append((temp_image_storage.name, filename_in_zip))
-                            logger.info(f"Stored {filename_in_zip} from ZIP to {temp_image_storage.name}")
-                    else:
-                        logger.info(f"Skipping non-image file or directory from ZIP: {filename_in_zip}")
-            
-            os.unlink(zip_download_path) # Clean up downloaded ZIP file
-            logger.info(f"Cleaned up downloaded ZIP: {zip_download_path}")
+            zip_data = io.BytesIO()
+            await file.download_to_memory(zip_data)
+            logger.info(f"Downloaded ZIP {document.file_name} ({format_size(zip_data.getbuffer().nbytes)})")
+
+            # Decompress in the worker pool so the event loop and running conversions aren't held up
+            loop = asyncio.get_running_loop()
+            zip_images = await loop.run_in_executor(CONVERSION_EXECUTOR, _read_zip_images, zip_data)
+            for filename_in_zip, image_data in zip_images:
+                image_size = image_data.getbuffer().nbytes
+                context.user_data['pending_images'].append(
+                    (image_data, filename_in_zip, detect_image_format(image_data, filename_in_zip), image_size)
+                )
+                logger.info(f"Loaded {filename_in_zip} from ZIP ({format_size(image_size)})")
 
             if not context.user_data['pending_images']:
                 await update.message.reply_text("The ZIP file did not contain any supported image files.")
@@ -379,11 +500,11 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             if context.user_data['message_to_edit']:
                 try:
-                    await context.user_data['message_to_edit'].edit_text(status_text, reply_markup=get_format_buttons())
+                    await context.user_data['message_to_edit'].edit_text(status_text, reply_markup=FORMAT_KEYBOARD)
                 except Exception: 
-                    context.user_data['message_to_edit'] = await update.message.reply_text(status_text, reply_markup=get_format_buttons())
+                    context.user_data['message_to_edit'] = await update.message.reply_text(status_text, reply_markup=FORMAT_KEYBOARD)
             else:
-                context.user_data['message_to_edit'] = await update.message.reply_text(status_text, reply_markup=get_format_buttons())
+                context.user_data['message_to_edit'] = await update.message.reply_text(status_text, reply_markup=FORMAT_KEYBOARD)
         else:
             await update.message.reply_text("Please send a ZIP file containing images or send images directly.")
 
@@ -392,6 +513,59 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Sorry, there was an error processing your file. Please try again.")
 
 
+def _convert_one(args):
+    """Convert a single image in memory. Runs in a worker thread.
+
+    args is a tuple of (image_data, original_filename, target_format).
+    Returns (converted_data, filename_in_zip, original_size, converted_size),
+    or None if the image was skipped.
+    """
+    image_data, original_filename, target_format = args
+    logger.info(f"Processing file: {original_filename}")
+
+    original_size = image_data.getbuffer().nbytes
+    if original_size == 0:
+        logger.warning(f"File {original_filename} is empty. Skipping.")
+        return None
+
+    img = Image.open(image_data)
+    logger.info(f"Opened {original_filename}: format={img.format}, mode={img.mode}, size={img.size}")
+    if img.format == 'JPEG':
+        # Let libjpeg pick its fastest decode path; at the full size this does not change the output
+        img.draft('RGB', img.size)
+
+    # Image mode conversion logic
+    if target_format == 'JPEG' and img.mode in ('RGBA', 'P'):
+        img = img.convert('RGB')
+    elif target_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    elif target_format == 'AVIF' and img.mode not in ('RGB', 'RGBA'): # AVIF often supports RGBA
+        logger.info(f"Converting image mode from {img.mode} to RGBA for AVIF.")
+        img = img.convert('RGBA')
+
+    # Construct the new filename for inside the zip
+    base, _ = os.path.splitext(original_filename)
+    filename_in_zip = f"{base}{SUPPORTED_FORMATS[target_format]}"
+
+    converted_data = io.BytesIO()
+    logger.info(f"Attempting to save {original_filename} as {target_format}")
+    img.save(converted_data, format=target_format, **SAVE_KWARGS.get(target_format, {})) # Pillow uses format string like 'JPEG', 'PNG'
+
+    converted_size = converted_data.getbuffer().nbytes
+    if converted_size == 0:
+        logger.error(f"Converted output for {original_filename} is empty after save. Skipping.")
+        return None
+    logger.info(f"Converted {original_filename} to {filename_in_zip} ({format_size(converted_size)})")
+
+    return converted_data, filename_in_zip, original_size, converted_size
+
+
+async def _edit_progress(status, progress_text):
+    """Edit the progress message, logging instead of raising on failure."""
+    try: await status.edit_text(progress_text)
+    except Exception as e_edit: logger.warning(f"Could not edit progress message: {e_edit}")
+
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks for format conversion."""
     query = update.callback_query
@@ -399,6 +573,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         target_format = query.data.split('_')[1].upper()
+        load_pil() # Before handing images to worker threads
         
         if 'pending_images' in context.user_data and context.user_data['pending_images']:
             pending_files_data = context.user_data['pending_images']
@@ -407,102 +582,92 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(status_message_text)
 
             start_time = time.time()
-            converted_files_paths = [] # Store (output_path, original_filename_for_zip)
             total_original_size = 0
             total_converted_size = 0
             successfully_converted_count = 0
 
-            for temp_file_path, original_filename in pending_files_data:
-                try:
-                    logger.info(f"Processing file: {temp_file_path} (original: {original_filename})")
-                    if not os.path.exists(temp_file_path):
-                        logger.error(f"File {temp_file_path} does not exist. Skipping.")
+            # Pillow releases the GIL while decoding/encoding, so threads give real parallelism here.
+            loop = asyncio.get_running_loop()
+            futures = {
+                loop.run_in_executor(CONVERSION_EXECUTOR, _convert_one, (image_data, original_filename, target_format)): index
+                for index, (image_data, original_filename, _, _) in enumerate(pending_files_data)
+            }
+            results = [None] * len(pending_files_data)
+            progress_task = None
+            last_edit = time.monotonic()
+
+            while futures:
+                done, _ = await asyncio.wait(futures.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    original_filename = pending_files_data[index][1]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Error converting image {original_filename}: {str(e)}", exc_info=e)
+                        await query.message.reply_text(f"⚠️ Error converting {original_filename}. Skipping it. Check logs.")
                         continue
-                    
-                    current_original_size = os.path.getsize(temp_file_path)
-                    if current_original_size == 0:
-                        logger.warning(f"File {temp_file_path} is empty. Skipping.")
+                    if result is None:
                         continue
+
+                    _, _, current_original_size, current_converted_size = result
                     total_original_size += current_original_size
-                    
-                    img = Image.open(temp_file_path)
-                    logger.info(f"Opened {temp_file_path}: format={img.format}, mode={img.mode}, size={img.size}")
-                    
-                    # Image mode conversion logic
-                    if target_format == 'JPEG' and img.mode in ('RGBA', 'P'):
-                        img = img.convert('RGB')
-                    elif target_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
-                        img = img.convert('RGBA')
-                    elif target_format == 'AVIF' and img.mode not in ('RGB', 'RGBA'): # AVIF often supports RGBA
-                        logger.info(f"Converting image mode from {img.mode} to RGBA for AVIF.")
-                        img = img.convert('RGBA')
-                    
-                    # Construct the new filename for inside the zip
-                    base, _ = os.path.splitext(original_filename)
-                    filename_in_zip = f"{base}{SUPPORTED_FORMATS[target_format]}"
-
-                    # Output path for the temporary converted file
-                    # We create it in a temporary directory that will be cleaned up by the OS or manually if needed.
-                    # Suffix ensures it has the correct extension for PIL to save correctly.
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=SUPPORTED_FORMATS[target_format]) as temp_conv_file:
-                        output_converted_path = temp_conv_file.name
-                    
-                    logger.info(f"Attempting to save to {output_converted_path} as {target_format} (for original: {original_filename})")
-                    img.save(output_converted_path, format=target_format) # Pillow uses format string like 'JPEG', 'PNG'
-                    logger.info(f"Saved {output_converted_path}")
-                    
-                    if not os.path.exists(output_converted_path) or os.path.getsize(output_converted_path) == 0:
-                        logger.error(f"Output file {output_converted_path} is missing or empty after save. Skipping.")
-                        if os.path.exists(output_converted_path): os.unlink(output_converted_path) # Clean up empty/failed file
-                        continue
-                    
-                    current_converted_size = os.path.getsize(output_converted_path)
                     total_converted_size += current_converted_size
                     stats.update_conversion_stats(current_original_size, current_converted_size, target_format)
-                    
-                    converted_files_paths.append((output_converted_path, filename_in_zip))
+
+                    results[index] = result
                     successfully_converted_count += 1
-                    
-                    if successfully_converted_count % 5 == 0 or successfully_converted_count == len(pending_files_data):
+
+                    # Rate-limit edits and don't wait for them, so conversion is never blocked on the API
+                    if (progress_task is None or progress_task.done()) and \
+                       time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
                         progress_text = (
                             f"Converting... {successfully_converted_count}/{len(pending_files_data)} images processed.\n"
                             f"Total size so far: {format_size(total_original_size)} → {format_size(total_converted_size)}"
                         )
-                        try: await status.edit_text(progress_text)
-                        except Exception as e_edit: logger.warning(f"Could not edit progress message: {e_edit}")
-
-                except Exception as e:
-                    logger.error(f"Error converting image {temp_file_path} (original: {original_filename}): {str(e)}", exc_info=True)
-                    await query.message.reply_text(f"⚠️ Error converting {original_filename}. Skipping it. Check logs.")
-                    if 'output_converted_path' in locals() and os.path.exists(output_converted_path):
-                         os.unlink(output_converted_path) # Clean up partially created file if error occurred after its creation
+                        progress_task = asyncio.create_task(_edit_progress(status, progress_text))
+                        last_edit = time.monotonic()
+
+            # Make sure a late progress edit can't overwrite the final status
+            if progress_task is not None:
+                await progress_task
+            stats.flush()
+
+            # Keep the original upload order inside the ZIP, renaming clashes such as a.png/a.jpg -> a.webp
+            converted_files = []
+            used_names = set()
+            for result in results:
+                if result is None:
                     continue
+                converted_data, filename_in_zip = result[0], result[1]
+                base, ext = os.path.splitext(filename_in_zip)
+                suffix = 1
+                while filename_in_zip.lower() in used_names:
+                    filename_in_zip = f"{base}_{suffix}{ext}"
+                    suffix += 1
+                used_names.add(filename_in_zip.lower())
+                converted_files.append((converted_data, filename_in_zip))
             
-            # After loop, if there are converted files, ZIP them up.
-            if converted_files_paths:
-                zip_filename_base = f"converted_images_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                zip_output_path = os.path.join(tempfile.gettempdir(), f"{zip_filename_base}.zip")
-                
-                logger.info(f"Creating ZIP file at {zip_output_path} with {len(converted_files_paths)} images.")
-                with zipfile.ZipFile(zip_output_path, 'w') as zipf:
-                    for file_path, filename_in_zip in converted_files_paths:
-                        zipf.write(file_path, arcname=filename_in_zip)
-                        logger.info(f"Added {file_path} as {filename_in_zip} to ZIP.")
-                
-                # Send the ZIP file
-                await context.bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=open(zip_output_path, 'rb'),
-                    caption=f"Converted {successfully_converted_count} images to {target_format}."
-                )
-                logger.info(f"Sent ZIP file {zip_output_path}")
-                
-                # Clean up the sent ZIP file and individual converted temp files
-                os.unlink(zip_output_path)
-                for file_path, _ in converted_files_paths:
-                    if os.path.exists(file_path):
-                        os.unlink(file_path)
-                logger.info("Cleaned up temporary converted files and ZIP.")
+            # After conversion, if there are converted files, ZIP them up.
+            if converted_files:
+                zip_filename = f"converted_images_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+                logger.info(f"Creating ZIP file {zip_filename} with {len(converted_files)} images.")
+                # Bot uploads are capped at 50 MB and PTB reads the whole document into memory
+                # before sending, so the archive is simply built in RAM.
+                with io.BytesIO() as zip_buffer:
+                    # Converted images are already compressed, so store them as-is
+                    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zipf:
+                        for converted_data, filename_in_zip in converted_files:
+                            zipf.writestr(filename_in_zip, converted_data.getbuffer())
+                            logger.info(f"Added {filename_in_zip} to ZIP.")
+
+                    # Send the ZIP file
+                    await context.bot.send_document(
+                        chat_id=query.message.chat_id,
+                        document=InputFile(zip_buffer.getvalue(), filename=zip_filename),
+                        caption=f"Converted {successfully_converted_count} images to {target_format}."
+                    )
+                    logger.info(f"Sent ZIP file {zip_filename}")
             else:
                 await query.message.reply_text("No images were successfully converted.")
 
@@ -519,12 +684,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await status.edit_text(final_status_text)
             logger.info(final_status_text)
 
-            # Cleanup original downloaded temp files
-            for temp_file_path, _ in pending_files_data:
-                if os.path.exists(temp_file_path):
-                    try: os.unlink(temp_file_path)
-                    except Exception as e_unlink: logger.error(f"Error unlinking original temp file {temp_file_path}: {e_unlink}")
-            
             context.user_data['pending_images'] = []
             context.user_data['message_to_edit'] = None
             